@@ -25,6 +25,11 @@ class ModelBrownian(ModelBase):
     def __call__(self, t, D, delta):
         return D+delta**2/(2*t*(1-2*self.R*self.dt/t))
 
+# %%
+# Optionally, the model can also define a ``jac(self, t, *params)`` method returning the partial derivatives with respect to each parameter as an array of shape ``(t.size, n_params)``.
+# If present, it is passed on to ``scipy.optimize.curve_fit``, which otherwise estimates the derivatives by finite differences.
+# The ``jac`` method is only used if it is defined in the same class as ``__call__``. When inheriting from one of the predefined models and overriding only ``__call__``, the inherited Jacobian is therefore ignored.
+
 # %%
 # After we've defined the model, we can simply add it to the :class:`trait2d.analysis.ModelDB`.
 
@@ -4,29 +4,32 @@ Loads and processes 3D data instead 2D data
 
 import pathlib
 
-import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Render figures to files instead of blocking on plt.show()
+import matplotlib.pyplot as plt
+import tqdm
 
-from trait2d.analysis import Track
+from trait2d.analysis import ListOfTracks
 
 if __name__ == '__main__':
     file = pathlib.Path(__file__).parent / 'example_data_3d.csv'
-    df = pd.read_csv(file)
-    ids = df['id'].unique()
-    tracks = []
-    for id in ids:
-        tracks.append(Track.from_dataframe(df, 'x (m)', 'y (m)', 'z (m)', 't (s)', 'id', 'metres', 'seconds', id))
-    for track in tracks:
+    output = pathlib.Path(__file__).parent / 'output'
+    output.mkdir(exist_ok=True)
+    tracks = ListOfTracks.from_file(file, col_name_x='x (m)', col_name_y='y (m)', col_name_z='z (m)',
+                                    col_name_t='t (s)', col_name_id='id', unit_length='metres', unit_time='seconds')
+    for track in tqdm.tqdm(tracks.get_tracks()):
         n = len(track.get_x())
         print('length {}'.format(n))
         track.adc_analysis(fraction_fit_points=0.99)
         track.msd_analysis(fraction_fit_points=0.99)
         track.get_msd_analysis_results()
         track.get_msd()
-        track.plot_msd()
         results = track.get_adc_analysis_results()['best_model']
         print(results)
-        track.plot_trajectory()
-        track.plot_adc_analysis_results()
-        track.plot_msd_analysis_results()
-        pass
-
+        figures = {'msd': track.plot_msd(show=False),
+                   'trajectory': track.plot_trajectory(show=False),
+                   'adc_analysis': track.plot_adc_analysis_results(show=False),
+                   'msd_analysis': track.plot_msd_analysis_results(show=False)}
+        for name, fig in figures.items():
+            fig.savefig(output / 'track_{}_{}.png'.format(track.get_id(), name))
+            plt.close(fig)
@@ -0,0 +1,106 @@
+import unittest
+
+import os
+import tempfile
+import warnings
+import numpy as np
+
+from trait2d.analysis import Track, ListOfTracks, ModelDB
+from trait2d.analysis.models import ModelBrownian, ModelImmobile
+
+class TestListOfTracksMethods(unittest.TestCase):
+
+    def setUp(self):
+        ModelDB().add_model(ModelBrownian)
+        ModelDB().add_model(ModelImmobile)
+
+    def tearDown(self):
+        ModelDB().cleanup()
+
+    # Test whether adc_summary averages MSD and D_app per model and over the ensemble.
+    def test_adc_summary(self):
+        rng = np.random.default_rng(0)
+        tracks = []
+        for i in range(8):
+            n = 60 + 10 * i
+            if i % 2:
+                # Freely diffusing
+                x = np.cumsum(rng.normal(0.0, 5e-8, n))
+                y = np.cumsum(rng.normal(0.0, 5e-8, n))
+            else:
+                # Localisation noise only
+                x = rng.normal(0.0, 2e-8, n)
+                y = rng.normal(0.0, 2e-8, n)
+            tracks.append(Track(x, y, np.arange(n) * 0.01, id=i))
+        tracks = ListOfTracks(tracks)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            tracks.adc_analysis()
+        best_models = [track.get_adc_analysis_results()["best_model"] for track in tracks.get_tracks()]
+        self.assertGreater(len(set(best_models)), 1)
+
+        # Expected averages, leaving out lags beyond the end of each track
+        L = max(track.get_msd().size for track in tracks.get_tracks())
+        MSD = np.full((len(best_models), L), np.nan)
+        D_app = np.full((len(best_models), L), np.nan)
+        for i, track in enumerate(tracks.get_tracks()):
+            MSD[i, :track.get_msd().size] = track.get_msd()
+            D_app[i, :track.get_msd().size] = track.get_adc_analysis_results()["Dapp"]
+        groups = {model: np.array(best_models) == model for model in set(best_models)}
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for ensemble_average in [False, True]:
+                for interpolation in [False, True]:
+                    results = tracks.adc_summary(ensemble_average=ensemble_average, interpolation=interpolation)
+                    for model, group in groups.items():
+                        self.assertAlmostEqual(results["sectors"][model], group.mean())
+                        params = [track.get_adc_analysis_results()["fit_results"][model]["params"]
+                                  for track, in_group in zip(tracks.get_tracks(), group) if in_group]
+                        self.assertTrue(np.allclose(results["average_params"][model], np.mean(params, axis=0)))
+                        self.assertTrue(np.allclose(results["average_msd"][model], np.nanmean(MSD[group], axis=0), equal_nan=True))
+                        self.assertTrue(np.allclose(results["average_dapp"][model], np.nanmean(D_app[group], axis=0), equal_nan=True))
+                    self.assertEqual("Ensemble" in results["average_msd"], ensemble_average)
+                    if ensemble_average:
+                        self.assertTrue(np.allclose(results["average_msd"]["Ensemble"], np.nanmean(MSD, axis=0)))
+                        self.assertTrue(np.allclose(results["average_dapp"]["Ensemble"], np.nanmean(D_app, axis=0)))
+
+    # Test whether a file with several tracks is split into one track per id.
+    def test_from_file(self):
+        ids = np.repeat([7, 3], [5, 6])
+        t = np.concatenate((np.arange(5), np.arange(6))) * 10.0
+        x = np.arange(11) * 1.0
+        y = np.arange(11) * 2.0
+        z = np.arange(11) * 3.0
+        with tempfile.TemporaryDirectory() as directory:
+            filename_2d = os.path.join(directory, "tracks_2d.csv")
+            filename_3d = os.path.join(directory, "tracks_3d.csv")
+            with open(filename_2d, "w") as f:
+                f.write("id,t,x,y\n")
+                for row in zip(ids, t, x, y):
+                    f.write(",".join(str(v) for v in row) + "\n")
+            with open(filename_3d, "w") as f:
+                f.write("id,t,x,y,z\n")
+                for row in zip(ids, t, x, y, z):
+                    f.write(",".join(str(v) for v in row) + "\n")
+            cases = [(ListOfTracks.from_file(filename_2d, unit_length='micrometres', unit_time='milliseconds'), 2),
+                     (ListOfTracks.from_file(filename_2d, unit_length='micrometres', unit_time='milliseconds', col_name_z='z'), 2),
+                     (ListOfTracks.from_file(filename_3d, unit_length='micrometres', unit_time='milliseconds'), 2),
+                     (ListOfTracks.from_file(filename_3d, unit_length='micrometres', unit_time='milliseconds', col_name_z='z'), 3)]
+
+        for tracks, dimension in cases:
+            self.assertEqual(len(tracks.get_tracks()), 2)
+            self.assertEqual([track.get_id() for track in tracks.get_tracks()], [7, 3])
+            for track in tracks.get_tracks():
+                rows = ids == track.get_id()
+                self.assertEqual(track.get_dimension(), dimension)
+                self.assertTrue(np.allclose(track.get_t(), t[rows] * 1e-3))
+                self.assertTrue(np.allclose(track.get_x(), x[rows] * 1e-6))
+                self.assertTrue(np.allclose(track.get_y(), y[rows] * 1e-6))
+                if dimension == 3:
+                    self.assertTrue(np.allclose(track.get_z(), z[rows] * 1e-6))
+                else:
+                    self.assertIsNone(track.get_z())
+
+if __name__ == '__main__':
+    unittest.main()
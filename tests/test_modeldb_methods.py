@@ -1,5 +1,7 @@
 import unittest
 
+import numpy as np
+
 from trait2d.analysis import ModelDB
 
 class TestModelDBMethods(unittest.TestCase):
@@ -27,5 +29,65 @@ class TestModelDBMethods(unittest.TestCase):
         with self.assertRaises(ValueError):
             ModelDB().get_model(ModelHop)
 
+    # Test whether the analytic Jacobians of all predefined models agree with finite differences.
+    def test_model_jac(self):
+        from trait2d.analysis import models
+        t = np.arange(1, 100) * 0.01
+        params = {models.ModelBrownian: [1.0e-12, 2.0e-8],
+                  models.ModelConfined: [1.0e-12, 2.0e-8, 0.3],
+                  models.ModelHop: [1.0e-12, 2.0e-12, 2.0e-8, 0.3],
+                  models.ModelImmobile: [2.0e-8],
+                  models.ModelHopModified: [1.0e-12, 2.0e-12, 0.4, 0.3],
+                  models.ModelLinear: [1.0e-12, 1.0e-16],
+                  models.ModelPower: [1.0e-12, 1.0e-16, 0.8]}
+        for model_class, p in params.items():
+            for R in [0.0, 1/6]:
+                model = model_class()
+                model.R = R
+                model.dt = 0.01
+                p = np.array(p)
+                J = model.jac(t, *p)
+                self.assertEqual(J.shape, (t.size, p.size))
+                for i in range(p.size):
+                    h = np.zeros(p.size)
+                    h[i] = 1e-6 * p[i]
+                    J_num = (model(t, *(p + h)) - model(t, *(p - h))) / (2 * h[i])
+                    self.assertTrue(np.allclose(J[:, i], J_num, rtol=1e-6, atol=1e-6 * np.abs(J_num).max()),
+                                    f"{model_class.__name__}, R={R}, parameter {i}")
+
+    # Test whether cached terms are recomputed when the lag times are modified in place.
+    def test_model_cache(self):
+        from trait2d.analysis.models import ModelConfined, ModelPower
+        t = np.arange(1, 100) * 0.01
+        for model, p in [(ModelConfined(), (1.0e-12, 2.0e-8, 0.3)), (ModelPower(), (1.0e-12, 1.0e-16, 0.8))]:
+            model(t, *p)
+            t *= 2.0
+            self.assertTrue(np.allclose(model(t, *p), model(np.copy(t), *p), rtol=1e-12, atol=0.0))
+            self.assertTrue(np.allclose(model.jac(t, *p), model.jac(np.copy(t), *p), rtol=1e-12, atol=0.0))
+
+    # Test whether subclasses that do not call ModelBase.__init__ can still be evaluated.
+    def test_model_subclass_init(self):
+        from trait2d.analysis.models import ModelConfined, ModelPower
+        t = np.arange(1, 100) * 0.01
+        for model_class, p in [(ModelConfined, (1.0e-12, 2.0e-8, 0.3)), (ModelPower, (1.0e-12, 1.0e-16, 0.8))]:
+            class ModelCustom(model_class):
+                def __init__(self):
+                    pass
+            model = ModelCustom()
+            model.R = 1/6
+            model.dt = 0.01
+            self.assertEqual(model(t, *p).shape, t.shape)
+            self.assertEqual(model.jac(t, *p).shape, (t.size, len(p)))
+
+    # Test whether an inherited Jacobian is ignored when only __call__ is overridden.
+    def test_model_jac_subclass(self):
+        from trait2d.analysis.models import ModelBrownian, _fit_jac
+        class ModelCustom(ModelBrownian):
+            def __call__(self, t, D, delta):
+                return D * t + delta
+        self.assertEqual(_fit_jac(ModelCustom()), "2-point")
+        model = ModelBrownian()
+        self.assertEqual(_fit_jac(model), model.jac)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -16,6 +16,20 @@ class TestTrackMethods(unittest.TestCase):
         track = Track.from_dict(TRACK_DATA['track'])
         self.assertEqual(track.get_size(), len(TRACK_DATA['track']['x']))
 
+    # Test whether the z column of a DataFrame is only used when it is specified.
+    def test_from_dataframe(self):
+        import pandas as pd
+        df = pd.DataFrame({'id': 1, 't': np.arange(10) * 1.0, 'x': np.arange(10) * 1.0,
+                           'y': np.arange(10) * 2.0, 'z': np.arange(10) * 3.0})
+        track = Track.from_dataframe(df, unit_length='nanometres')
+        self.assertEqual(track.get_dimension(), 2)
+        self.assertIsNone(track.get_z())
+        track = Track.from_dataframe(df, col_name_z='z', unit_length='nanometres')
+        self.assertEqual(track.get_dimension(), 3)
+        self.assertEqual(track.get_id(), 1)
+        self.assertTrue(np.allclose(track.get_x(), df['x'] * 1e-9))
+        self.assertTrue(np.allclose(track.get_z(), df['z'] * 1e-9))
+
     # Test whether the MSD and the error is calculated correctly for artificial dataset.
     def test_calculate_msd(self):
         track = Track.from_dict(TRACK_DATA['track'])
@@ -24,6 +38,101 @@ class TestTrackMethods(unittest.TestCase):
         self.assertTrue(np.isclose(track.get_msd(), TRACK_DATA['msd']).all())
         self.assertTrue(np.isclose(track.get_msd_error(), TRACK_DATA['msd_error']).all())
 
+    # Test whether the MSD is the same when the lags are split into several blocks.
+    def test_calculate_msd_blocks(self):
+        from trait2d.analysis import _msd
+        track = Track.from_dict(TRACK_DATA['track'])
+        block_size = _msd._MSD_BLOCK_SIZE
+        try:
+            _msd._MSD_BLOCK_SIZE = 5000
+            track.calculate_msd()
+        finally:
+            _msd._MSD_BLOCK_SIZE = block_size
+        self.assertTrue(np.isclose(track.get_msd(), TRACK_DATA['msd']).all())
+        self.assertTrue(np.isclose(track.get_msd_error(), TRACK_DATA['msd_error']).all())
+
+    # Test whether the MSD is recalculated only after the trajectory changed.
+    def test_calculate_msd_cache(self):
+        # Copy the coordinates since the track does not copy float64 arrays.
+        track = Track(np.copy(TRACK_DATA['track']['x']), np.copy(TRACK_DATA['track']['y']), TRACK_DATA['track']['t'])
+        track.calculate_msd()
+        msd = track.get_msd()
+        track.calculate_msd()
+        self.assertIs(track.get_msd(), msd)
+        track.get_x()[:] *= 2.0
+        track.calculate_msd()
+        self.assertIsNot(track.get_msd(), msd)
+        self.assertFalse(np.isclose(track.get_msd(), TRACK_DATA['msd']).all())
+
+    # Test whether a missing localisation only affects the lags that include it.
+    def test_calculate_msd_nan(self):
+        x = np.copy(TRACK_DATA['track']['x'][:50])
+        y = np.copy(TRACK_DATA['track']['y'][:50])
+        x[20] = np.nan
+        track = Track(x, y, TRACK_DATA['track']['t'][:50])
+        track.calculate_msd()
+
+        pos = np.column_stack((x, y))
+        sd = [np.sum((pos[1 + i:] - pos[1:-i])**2, axis=1) for i in range(1, 48)]
+        msd = np.array([np.mean(s) for s in sd])
+        msd_error = np.array([np.std(s) for s in sd])
+        self.assertTrue(np.isnan(msd).any() and not np.isnan(msd).all())
+        self.assertTrue(np.allclose(track.get_msd(), msd, equal_nan=True))
+        self.assertTrue(np.allclose(track.get_msd_error(), msd_error, equal_nan=True))
+
+        # The MSD of a track with missing localisations is cached as well
+        msd = track.get_msd()
+        track.calculate_msd()
+        self.assertIs(track.get_msd(), msd)
+
+    # Test whether single precision coordinates give approximately the same MSD.
+    def test_calculate_msd_float32(self):
+        track = Track(TRACK_DATA['track']['x'], TRACK_DATA['track']['y'], TRACK_DATA['track']['t'], dtype=np.float32)
+        self.assertEqual(track.get_x().dtype, np.float32)
+        track.calculate_msd()
+        self.assertTrue(np.isclose(track.get_msd(), TRACK_DATA['msd'], rtol=1e-3).all())
+        self.assertTrue(np.isclose(track.get_msd_error(), TRACK_DATA['msd_error'], rtol=1e-3).all())
+
+        # With a strong drift the standard deviation is tiny compared to the mean.
+        x = np.arange(2000) * 1e-6 + np.cumsum(np.random.default_rng(0).normal(0.0, 3e-8, 2000))
+        y = np.zeros(2000)
+        t = np.arange(2000) * 0.01
+        track = Track(x, y, t, dtype=np.float32)
+        reference = Track(x.astype(np.float32).astype(np.float64), y, t)
+        track.calculate_msd()
+        reference.calculate_msd()
+        self.assertTrue(np.allclose(track.get_msd(), reference.get_msd(), rtol=1e-9, atol=0.0))
+        self.assertTrue(np.allclose(track.get_msd_error(), reference.get_msd_error(), rtol=1e-9, atol=0.0))
+
+    # Test whether the z coordinate of a 3D track is included in the MSD.
+    def test_calculate_msd_3d(self):
+        track_2d = Track.from_dict(TRACK_DATA['track'])
+        track_3d = Track(TRACK_DATA['track']['x'], np.zeros(track_2d.get_size()), TRACK_DATA['track']['t'], z=TRACK_DATA['track']['y'])
+        self.assertEqual(track_3d.get_dimension(), 3)
+        track_3d.calculate_msd()
+        self.assertTrue(np.isclose(track_3d.get_msd(), TRACK_DATA['msd']).all())
+        self.assertTrue(np.isclose(track_3d.get_msd_error(), TRACK_DATA['msd_error']).all())
+
+    # Test whether the closed-form linear MSD fit agrees with scipy.optimize.curve_fit.
+    def test_msd_linear_fit(self):
+        from scipy import optimize
+        from trait2d.analysis._msd import _linear_fit
+        from trait2d.analysis.models import ModelLinear
+        track = Track.from_dict(TRACK_DATA['track'])
+        track.calculate_msd()
+        n_points = int(0.25 * track.get_msd().size)
+        T = (track.get_t()[1:-2] - track.get_t().min())[:n_points]
+        msd = track.get_msd()[:n_points]
+        msd_error = track.get_msd_error()[:n_points]
+        model = ModelLinear()
+        model.R = 1/6
+        model.dt = track.get_t()[1] - track.get_t()[0]
+        popt, pcov = _linear_fit(model, T, msd, msd_error)
+        popt_ref, pcov_ref = optimize.curve_fit(model, T, msd, p0=popt * 0.5, sigma=msd_error, method='trf',
+                                                bounds=(0.0, np.inf), jac=model.jac, xtol=1e-15, ftol=1e-15, gtol=1e-15)
+        self.assertTrue(np.allclose(popt, popt_ref, rtol=1e-6, atol=0.0))
+        self.assertTrue(np.allclose(pcov, pcov_ref, rtol=1e-6, atol=0.0))
+
     # Test whether ADC analysis produces results for artificial dataset.
     # (Note: Does not check for actual results of analysis as these might change between versions.)
     def test_adc_analysis(self):
@@ -38,5 +147,23 @@ class TestTrackMethods(unittest.TestCase):
         track.msd_analysis()
         self.assertTrue(track.get_msd_analysis_results() != None)
 
+    # Test whether the plot methods return the figure when it is not shown.
+    def test_plot_show(self):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        from matplotlib.figure import Figure
+        track = Track.from_dict(TRACK_DATA['track'])
+        track.msd_analysis()
+        track.adc_analysis()
+        for plot in [track.plot_msd, track.plot_msd_analysis_results, track.plot_adc_analysis_results]:
+            fig = plot(show=False)
+            self.assertIsInstance(fig, Figure)
+            plt.close(fig)
+        # The MSD plot stays non-blocking by default
+        fig = track.plot_msd()
+        self.assertIsInstance(fig, Figure)
+        plt.close(fig)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
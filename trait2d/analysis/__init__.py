@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-import tqdm
 import warnings
 import logging
 import csv
@@ -11,10 +10,10 @@ from scipy import interpolate
 import pandas as pd
 
 from trait2d.exceptions import *
+from trait2d.analysis._msd import _msd_moments
+from trait2d.analysis.models import _fit_jac
 
-import itertools
 import os
-from concurrent.futures import ProcessPoolExecutor
 
 class Borg:
     _shared_state = {}
@@ -106,7 +105,7 @@ class ListOfTracks:
         self._tracks = tracks
 
     @classmethod
-    def from_file(cls, filename, format=None, col_name_x='x', col_name_y='y', col_name_t='t', col_name_id='id', unit_length='metres', unit_time='seconds'):
+    def from_file(cls, filename, format=None, col_name_x='x', col_name_y='y', col_name_t='t', col_name_id='id', unit_length='metres', unit_time='seconds', col_name_z=''):
         """Create a ListOfTracks from a file containing multiple tracks. Currently only supports '.csv' files.
         The file must contain the fields 'x', 'y', 't' as well as 'id'. Different column names can also be
         specified using the appropriate arguments.
@@ -129,8 +128,8 @@ class ListOfTracks:
             Length unit of track data. Either 'metres', 'millimetres', 'micrometres' or 'nanometres'.
         unit_time: str
             Time unit of track data. Either 'seconds', 'milliseconds', 'microseconds' or 'nanoseconds'.
-        id: int
-            Track ID in case the file contains more than one track.
+        col_name_z: str
+            Column title of z positions. Leave empty for 2D tracks.
 
         Raises
         ------
@@ -140,10 +139,12 @@ class ListOfTracks:
             When the file contains multiple tracks but no id is specified.
         """
         df = pd.read_csv(filename)
-        ids = df[col_name_id].unique()
         tracks = []
-        for id in ids:
-            tracks.append(Track.from_dataframe(df, col_name_x, col_name_y, col_name_t, col_name_id, unit_length, unit_time, id))
+        # Split the DataFrame in a single pass instead of filtering it once per id
+        for id, df_track in df.groupby(col_name_id, sort=False):
+            tracks.append(Track.from_dataframe(df_track, col_name_x=col_name_x, col_name_y=col_name_y, col_name_z=col_name_z,
+                                               col_name_t=col_name_t, col_name_id=col_name_id,
+                                               unit_length=unit_length, unit_time=unit_time, id=id))
         return cls(tracks)
 
     def __repr__(self):
@@ -243,12 +244,9 @@ class ListOfTracks:
         for track in self._tracks:
             segs = []
             colors = []
-            x = track.get_x()
-            y = track.get_y()
-            t = track.get_t()
-            x -= x[0]
-            y -= y[0]
-            t -= t[0]
+            x = track.get_x() - track.get_x()[0]
+            y = track.get_y() - track.get_y()[0]
+            t = track.get_t() - track.get_t()[0]
             tmax = t.max()
             tmin = t.min()
             tdif = tmax - tmin
@@ -429,35 +427,36 @@ class ListOfTracks:
                                  "enable interpolation with interpolation = True.".format(
                     track.get_t()[1] - track.get_t()[0], dt, k + 1))
 
-        if not avg_only_params:
-            for track in self._tracks:
-                if track.get_adc_analysis_results() is None:
-                    continue
-
-                model = track.get_adc_analysis_results()["best_model"]
-
-                D_app = np.zeros(track_length - 3)
-                MSD = np.zeros(track_length - 3)
+        if not avg_only_params or ensemble_average:
+            # Gather D_app and MSD of all analysed tracks in one array each
+            analysed = [track for track in self._tracks if track.get_adc_analysis_results() is not None]
+            D_app = np.zeros((len(analysed), track_length - 3))
+            MSD = np.zeros((len(analysed), track_length - 3))
+            for i, track in enumerate(analysed):
                 if interpolation:
                     interp_MSD = interpolate.interp1d(track.get_t()[0:-3], track.get_msd(), bounds_error = False, fill_value = 0)
                     interp_D_app = interpolate.interp1d(track.get_t()[0:-3], track.get_adc_analysis_results()["Dapp"], bounds_error = False, fill_value = 0)
-                    MSD = interp_MSD(t[0:-3])
-                    D_app = interp_D_app(t[0:-3])
+                    MSD[i] = interp_MSD(t[0:-3])
+                    D_app[i] = interp_D_app(t[0:-3])
                 else:
-                    D_app[0:track.get_adc_analysis_results()["Dapp"].size] = track.get_adc_analysis_results()["Dapp"]
-                    MSD[0:track.get_msd().size] = track.get_msd()
-                mask = np.zeros(track_length - 3)
-                np.put(mask, np.where(MSD != 0.0), 1)
+                    D_app[i, 0:track.get_adc_analysis_results()["Dapp"].size] = track.get_adc_analysis_results()["Dapp"]
+                    MSD[i, 0:track.get_msd().size] = track.get_msd()
+            mask = (MSD != 0.0).astype(float)
 
-
-                if not model in average_D_app.keys():
-                    average_D_app[model] = np.zeros(track_length - 3)
-                    average_MSD[model] = np.zeros(track_length - 3)
-                    sampled[model] = np.zeros(track_length - 3)
-
-                average_D_app[model] += D_app
-                average_MSD[model] += MSD
-                sampled[model] += mask
+        if not avg_only_params:
+            # Sum up the tracks of each model in a single grouped reduction
+            models = list(dict.fromkeys(track.get_adc_analysis_results()["best_model"] for track in analysed))
+            labels = np.array([models.index(track.get_adc_analysis_results()["best_model"]) for track in analysed], dtype=int)
+            sum_D_app = np.zeros((len(models), track_length - 3))
+            sum_MSD = np.zeros((len(models), track_length - 3))
+            sum_sampled = np.zeros((len(models), track_length - 3))
+            np.add.at(sum_D_app, labels, D_app)
+            np.add.at(sum_MSD, labels, MSD)
+            np.add.at(sum_sampled, labels, mask)
+            for i, model in enumerate(models):
+                average_D_app[model] = sum_D_app[i]
+                average_MSD[model] = sum_MSD[i]
+                sampled[model] = sum_sampled[i]
 
         counter_sum = 0
         for model in counter:
@@ -478,36 +477,11 @@ class ListOfTracks:
         
         
         if ensemble_average:
-            ens_D_app = np.zeros(track_length - 3)
-            ens_MSD = np.zeros(track_length - 3)
-            sampled_total = np.zeros(track_length - 3)
-            
-            for track in self._tracks:
-                if track.get_adc_analysis_results() is None:
-                    continue
-                
-                D_app = np.zeros(track_length - 3)
-                MSD = np.zeros(track_length - 3)
+            sampled_total = mask.sum(axis=0)
 
-                if interpolation:
-                    interp_MSD = interpolate.interp1d(track.get_t()[0:-3], track.get_msd(), bounds_error = False, fill_value = 0)
-                    interp_D_app = interpolate.interp1d(track.get_t()[0:-3], track.get_adc_analysis_results()["Dapp"], bounds_error = False, fill_value = 0)
-                    MSD = interp_MSD(t[0:-3])
-                    D_app = interp_D_app(t[0:-3])
-                else:
-                    D_app[0:track.get_adc_analysis_results()["Dapp"].size] = track.get_adc_analysis_results()["Dapp"]
-                    MSD[0:track.get_msd().size] = track.get_msd()
-                    
-                mask_total = np.zeros(track_length - 3)
-                np.put(mask_total, np.where(MSD != 0.0), 1)
-                
-                sampled_total += mask_total
-                ens_D_app += D_app
-                ens_MSD += MSD
-            
             #Final averaging operation#
-            average_MSD['Ensemble'] = ens_MSD/sampled_total
-            average_D_app['Ensemble'] = ens_D_app/sampled_total
+            average_MSD['Ensemble'] = MSD.sum(axis=0)/sampled_total
+            average_D_app['Ensemble'] = D_app.sum(axis=0)/sampled_total
             
         ###END OF ADDITION###
 
@@ -738,12 +712,21 @@ class Track:
         y coordinates of trajectory.
     t: array_like
         time coordinates of trajectory.
+    id: int
+        ID of the track.
+    z: array_like
+        z coordinates of trajectory. Leave as None for 2D tracks.
+    dtype: data-type
+        Floating point type used to store the coordinates. np.float32 halves the
+        memory used by long tracks at the cost of precision of the stored coordinates.
+        Time coordinates, the MSD calculation and all fits always use np.float64.
     """
 
-    def __init__(self, x=None, y=None, t=None, id=None):
-        self._x = np.array(x, dtype=float)
-        self._y = np.array(y, dtype=float)
-        self._t = np.array(t, dtype=float)
+    def __init__(self, x=None, y=None, t=None, id=None, z=None, dtype=np.float64):
+        self._x = np.ascontiguousarray(x, dtype=dtype)
+        self._y = np.ascontiguousarray(y, dtype=dtype)
+        self._z = None if z is None else np.ascontiguousarray(z, dtype=dtype)
+        self._t = np.ascontiguousarray(t, dtype=np.float64)
         self._tstamp = self._t              #this parameter will contain the original timestamps of the localizations. Useful for future generalizations
 
         self._id = id
@@ -751,6 +734,7 @@ class Track:
         self._msd = None
         self._msd_error = None
         self._msd_SEM = None
+        self._msd_cache_key = None
 
         self._msd_analysis_results = None
         self._adc_analysis_results = None
@@ -762,11 +746,12 @@ class Track:
         ----------
         dict: dict
             Dictionary of the track. Has to contain the fields "x", "y" and "t".
+            The field "z" is used if present.
         """
-        return cls(dict["x"], dict["y"], dict["t"])
+        return cls(dict["x"], dict["y"], dict["t"], z=dict.get("z"))
 
     @classmethod
-    def from_dataframe(cls, df, col_name_x='x', col_name_y='y', col_name_z='z', col_name_t='t', col_name_id='id', unit_length='metres', unit_time='seconds', id=None):
+    def from_dataframe(cls, df, col_name_x='x', col_name_y='y', col_name_z='', col_name_t='t', col_name_id='id', unit_length='metres', unit_time='seconds', id=None):
         """Create a single track from a DataFrame. Currently only supports '.csv' tracks.
         The DataFrame must contain the fields 'x', 'y', 't' as well as 'id'. Different column names can also be
         specified using the appropriate arguments.
@@ -779,6 +764,9 @@ class Track:
             Column title of x positions.
         col_name_y: str
             Column title of y positions.
+        col_name_z: str
+            Column title of z positions. Leave empty for 2D tracks. If the DataFrame has no such
+            column, a 2D track is created as well.
         col_name_t: str
             Column title of time.
         col_name_id: str
@@ -825,6 +813,7 @@ class Track:
 
         x = None
         y = None
+        z = None
         t = None
         if col_name_id in df:
             if np.min(df[col_name_id]) == np.max(df[col_name_id]):
@@ -835,14 +824,17 @@ class Track:
             if df.empty:
                 raise LoadTrackIdNotFoundError("There is no track associated with the specified id!")
 
-        x = np.array(df[col_name_x])
-        y = np.array(df[col_name_y])
-        t = np.array(df[col_name_t])
+        # Convert each column only once; the scaling allocates the final arrays.
+        x = np.multiply(df[col_name_x].to_numpy(dtype=np.float64), length_factor)
+        y = np.multiply(df[col_name_y].to_numpy(dtype=np.float64), length_factor)
+        t = np.multiply(df[col_name_t].to_numpy(dtype=np.float64), time_factor)
+        if col_name_z and col_name_z in df:
+            z = np.multiply(df[col_name_z].to_numpy(dtype=np.float64), length_factor)
 
-        return cls(x * length_factor, y * length_factor, t * time_factor, id=id)
+        return cls(x, y, t, id=id, z=z)
 
     @classmethod
-    def from_file(cls, filename, format=None, col_name_x='x', col_name_y='y', col_name_t='t', col_name_id='id', unit_length='metres', unit_time='seconds', id=None):
+    def from_file(cls, filename, format=None, col_name_x='x', col_name_y='y', col_name_t='t', col_name_id='id', unit_length='metres', unit_time='seconds', id=None, col_name_z=''):
         """Create a single track from a file. Currently only supports '.csv' tracks.
         The DataFrame must contain the fields 'x', 'y', 't' as well as 'id'. Different column names can also be
         specified using the appropriate arguments.
@@ -867,6 +859,8 @@ class Track:
             Time unit of track data. Either 'seconds', 'milliseconds', 'microseconds' or 'nanoseconds'.
         id: int
             Track ID in case the file contains more than one track.
+        col_name_z: str
+            Column title of z positions. Leave empty for 2D tracks.
 
         Raises
         ------
@@ -885,7 +879,9 @@ class Track:
             raise ValueError("Unknown format: {}".format(format))
         if format == "csv":
             df = pd.read_csv(filename)
-            return cls.from_dataframe(df, col_name_x, col_name_y, '', col_name_t, col_name_id, unit_length, unit_time, id)
+            return cls.from_dataframe(df, col_name_x=col_name_x, col_name_y=col_name_y, col_name_z=col_name_z,
+                                      col_name_t=col_name_t, col_name_id=col_name_id,
+                                      unit_length=unit_length, unit_time=unit_time, id=id)
         elif format == "json":
             # TODO: .json-specific import
             raise NotImplementedError(
@@ -922,7 +918,7 @@ class Track:
     from ._adc import adc_analysis, get_adc_analysis_results,\
                       delete_adc_analysis_results, plot_adc_analysis_results
 
-    def plot_trajectory(self, cmap='plasma'):
+    def plot_trajectory(self, cmap='plasma', show: bool = True):
         """Plot the trajectory.
 
         Parameters
@@ -930,13 +926,20 @@ class Track:
         cmap : str
             Name of the colormap to use (see https://matplotlib.org/tutorials/colors/colormaps.html
             for a list of possible values)
+        show: bool
+            If False, return the figure instead of calling plt.show().
+
+        Returns
+        -------
+        figure: matplotlib.figure.Figure
+            The figure if show is False, otherwise None.
         """
         import matplotlib.pyplot as plt
         from matplotlib.collections import LineCollection
         from matplotlib.ticker import FuncFormatter
         from matplotlib.cm import get_cmap
         cmap = get_cmap(cmap)
-        plt.figure()
+        fig = plt.figure()
         ax = plt.gca()
         segs = []
         colors = []
@@ -966,19 +969,38 @@ class Track:
             FuncFormatter(lambda x, pos: "%d" % int(x * 1e9)))
         ax.set_xlabel("x (nm)")
         ax.set_ylabel("y (nm)")
-        plt.show()
+        if show:
+            plt.show()
+        else:
+            return fig
+
+    def plot_msd(self, show: bool = False):
+        """Plot the mean squared displacement.
+
+        Parameters
+        ----------
+        show: bool
+            If True, call plt.show() instead of returning the figure.
 
-    def plot_msd(self):
+        Returns
+        -------
+        figure: matplotlib.figure.Figure
+            The figure if show is False, otherwise None.
+        """
         t = self._t[1:-2]-self._t.min()
         msd = self._msd
         err = self._msd_error
         import matplotlib.pyplot as plt
-        plt.figure()
+        fig = plt.figure()
         plt.grid(linestyle='dashed', color='grey')
         plt.xlabel("t")
         plt.ylabel("MSD")
         plt.semilogx(t, msd, color='black')
         plt.fill_between(t, msd-err, msd+err, color='black', alpha=0.5)
+        if show:
+            plt.show()
+        else:
+            return fig
 
     def get_x(self):
         """Return x coordinates of trajectory."""
@@ -988,6 +1010,10 @@ class Track:
         """Return y coordinates of trajectory."""
         return self._y
 
+    def get_z(self):
+        """Return z coordinates of trajectory or None for 2D tracks."""
+        return self._z
+
     def get_t(self):
         """Return time coordinates of trajectory."""
         return self._t
@@ -1000,9 +1026,28 @@ class Track:
         """Return number of points of the trajectory."""
         return self._t.size
 
+    def get_dimension(self):
+        """Return number of spatial dimensions of the trajectory (2 or 3)."""
+        return 2 if self._z is None else 3
+
+    def _msd_key(self):
+        """Return a cheap summary of the trajectory used to detect a stale MSD."""
+        axes = (self._x, self._y) if self._z is None else (self._x, self._y, self._z)
+        # Compare the sums bitwise, as NaN (missing localisations) never equals itself
+        return tuple((a.ctypes.data, a.size, a.sum().tobytes()) for a in axes)
+
+    def _positions(self):
+        """Return the positions as an array of shape (N, d)."""
+        if self._z is None:
+            return np.column_stack((self._x, self._y))
+        return np.column_stack((self._x, self._y, self._z))
+
     def get_trajectory(self):
         """Returns the trajectory as a dictionary."""
-        return {"t": self._t.tolist(), "x": self._x.tolist(), "y": self._y.tolist()}
+        trajectory = {"t": self._t.tolist(), "x": self._x.tolist(), "y": self._y.tolist()}
+        if self._z is not None:
+            trajectory["z"] = self._z.tolist()
+        return trajectory
 
     def is_msd_calculated(self):
         """Returns True if the MSD of this track has already been calculated."""
@@ -1029,7 +1074,7 @@ class Track:
             Normalize the time component of the track by setting the first time in the
             track to zero.
         normalize_xy: bool
-            Normalize the x and y coordinates of the track by setting the initial
+            Normalize the x and y (and z) coordinates of the track by setting the initial
             position in the track to zero.
 
         Returns
@@ -1039,10 +1084,12 @@ class Track:
 
         x = self._x
         y = self._y
+        z = self._z
         t = self._t
         
         xmin = 0.0
         ymin = 0.0
+        zmin = None if z is None else 0.0
         tmin = 0.0
 
         # Normalizing the coordinates
@@ -1051,44 +1098,43 @@ class Track:
             ymin = y.min()
             x = x - xmin
             y = y - ymin
+            if z is not None:
+                zmin = z.min()
+                z = z - zmin
         if normalize_t:
             tmin = t.min()
             t = t - tmin
 
         # Create normalized Track object
-        return NormalizedTrack(x, y, t, xmin, ymin, tmin, id=self._id)
+        return NormalizedTrack(x, y, t, xmin, ymin, tmin, id=self._id, z=z, zmin=zmin, dtype=self._x.dtype)
 
     def calculate_msd(self):
         
         """Calculates the track's mean squared displacement (msd) and stores it in 'track' object. Also deletes temporary values and colelcts them.
            Furthermore, calculates the standard deviation per point of the MSD array (msd_error) and the standard error of the mean (SEM) [legacy version].
+           For 3D tracks, the z coordinate is included in the displacements.
+           The MSD is only recalculated if the trajectory has changed since the last call.
         """
-                
-        N = len(self._x)
-        col_Array  = np.zeros(N-3)
-        Err_col_Array = np.zeros(N-3)
+        key = self._msd_key()
+        if self._msd is not None and key == self._msd_cache_key:
+            return
+
+        col_Array, Err_col_Array = _msd_moments(self._positions())
 
-        data_tmp = np.column_stack((self._x, self._y))
-    
-        for i in tqdm.tqdm(range(1,N-2)):
-            calc_tmp = np.sum(np.abs((data_tmp[1+i:N,:] - data_tmp[1:N - i,:]) ** 2), axis=1)
-            col_Array[i-1] = np.mean(calc_tmp)
-            Err_col_Array[i-1] = np.std(calc_tmp)
-            
         d = np.arange(self._x.shape[0] - 1, 2, -1)
 
         self._msd = col_Array                       #store MSD
         self._msd_error = Err_col_Array             #store stdev of MSD
         self._msd_SEM = Err_col_Array/(np.sqrt(d))  #calculate and store SEM of MSD
+        self._msd_cache_key = key
         
 
-    def _categorize(self, Dapp, J, Dapp_err = None, R: float = 1/6, fraction_fit_points: float = 0.25, fit_max_time: float=None, maxfev=1000, enable_log_sampling = False, log_sampling_dist = 0.2, weighting = 'error'):
+    def _categorize(self, Dapp, J, T, Dapp_err = None, R: float = 1/6, fraction_fit_points: float = 0.25, fit_max_time: float=None, maxfev=1000, enable_log_sampling = False, log_sampling_dist = 0.2, weighting = 'error'):
         if fraction_fit_points > 0.25:
             warnings.warn(
                 "Using too many points for the fit means including points which have higher measurment errors.")
 
         dt = self._t[1] - self._t[0]
-        T = J * dt
 
         # Get number of points for fit from either fit_max_time or fraction_fit_points
         if fit_max_time is not None:
@@ -1123,31 +1169,37 @@ class Track:
         if weighting == 'error':
             sigma = error
         elif weighting == 'inverse_variance':
-            sigma = np.power(error, 2.0)
+            sigma = np.square(error)
         elif weighting == 'variance':
-            sigma = 1 / np.power(error, 2.0)
+            sigma = 1 / np.square(error)
         elif weighting == 'disabled':
             sigma = None
         else:
             raise ValueError("Unknown weighting method: {}. Possible values are: 'error', 'variance', 'inverse_variance', and 'disabled'.".format(weighting))
 
+        # The fitted data is the same for all models
+        T_fit = T[idxs]
+        Dapp_fit = Dapp[idxs]
+
+        # Imported here since scipy.stats is slow to import
+        from scipy.stats import kstest
+
         for model in ModelDB().models:
             model.R = R
             model.dt = dt
             model_name = model.__class__.__name__
 
-            r = optimize.curve_fit(model, T[idxs], Dapp[idxs], p0 = model.initial,
-                        sigma = sigma, maxfev = maxfev, method='trf', bounds=(model.lower, model.upper))
+            r = optimize.curve_fit(model, T_fit, Dapp_fit, p0 = model.initial,
+                        sigma = sigma, maxfev = maxfev, method='trf', bounds=(model.lower, model.upper), jac=_fit_jac(model))
 
             perr = np.sqrt(np.diag(r[1]))
-            pred = model(T, *r[0])
-            bic = BIC(pred[idxs], Dapp[idxs], len(r[0]), len(idxs))
+            pred = model(T_fit, *r[0])
+            bic = BIC(pred, Dapp_fit, len(r[0]), len(idxs))
             if bic < bic_min:
                 bic_min = bic
                 category = model_name
 
-            from scipy.stats import kstest
-            test_results = kstest(Dapp[idxs], pred[idxs], N = len(idxs))
+            test_results = kstest(Dapp_fit, pred, N = len(idxs))
 
             fit_results[model_name] = {"params": r[0], "errors": perr, "bic" : bic, "KSTestStat": test_results[0], "KStestPValue": test_results[1]}
 
@@ -1164,10 +1216,11 @@ class Track:
 class NormalizedTrack(Track):
     """A track with normalized coordinates and additional information about the normalization."""
 
-    def __init__(self, x=None, y=None, t=None, xmin=None, ymin=None, tmin=None, id=None):
-        Track.__init__(self, x, y, t, id=id)
+    def __init__(self, x=None, y=None, t=None, xmin=None, ymin=None, tmin=None, id=None, z=None, zmin=None, dtype=np.float64):
+        Track.__init__(self, x, y, t, id=id, z=z, dtype=dtype)
         self._xmin = xmin
         self._ymin = ymin
+        self._zmin = zmin
         self._tmin = tmin
 
 class MSDTrack(Track):
@@ -1224,6 +1277,6 @@ def BIC(pred: list, target: list, k: int, n: int):
         Bayesian Information Criterion
     """
     # Compute RSS
-    RSS = np.sum((np.array(pred) - np.array(target)) ** 2)
+    RSS = np.sum(np.square(np.asarray(pred) - np.asarray(target)))
     bic = k * np.log(n) + n * np.log(RSS / n)
     return bic
\ No newline at end of file
@@ -1,7 +1,18 @@
 from trait2d.analysis import ModelDB
 
+import functools
 import numpy as np
 
+@functools.lru_cache(maxsize=64)
+def _time_grid(N):
+    """Lag indices 1 to N, shared between analyses of tracks with the same length.
+
+    The returned array is cached and therefore read-only.
+    """
+    J = np.arange(1, N + 1, dtype=np.float64)
+    J.setflags(write=False)
+    return J
+
 def delete_adc_analysis_results(self):
     """ Delete the ADC analysis results."""
     self._adc_analysis_results = None
@@ -39,9 +50,8 @@ def adc_analysis(self, R: float = 1/6, fraction_fit_points: float=0.25, fit_max_
         Dictionary containing all analysis results.
         Can also be retreived using `Track.get_adc_analysis_results()`.
     """
-    # Calculate MSD if this has not been done yet.
-    if self._msd is None:
-        self.calculate_msd()
+    # Calculate MSD if this has not been done yet or the trajectory has changed.
+    self.calculate_msd()
 
     dt = self._t[1] - self._t[0]
 
@@ -49,18 +59,19 @@ def adc_analysis(self, R: float = 1/6, fraction_fit_points: float=0.25, fit_max_
 
     # Time coordinates
     # This is the time array, as the fits will be MSD vs T
-    T = np.linspace(dt, dt*N, N, endpoint=True)
+    J = _time_grid(N)
+    T = J * dt
 
     # Compute  the time-dependent apparent diffusion coefficient.
-    Dapp = self._msd / (4 * T * (1 - 2*R*dt / T))
-    Dapp_err = self._msd_error / (4 * T * (1 - 2*R*dt / T))
+    denominator = 2 * self.get_dimension() * T * (1 - 2*R*dt / T)
+    Dapp = self._msd / denominator
+    Dapp_err = self._msd_error / denominator
 
-    model, fit_indices, fit_results = self._categorize(np.array(Dapp), np.arange(
-        1, N+1), Dapp_err = Dapp_err, R=R, fraction_fit_points=fraction_fit_points, fit_max_time=fit_max_time, maxfev=maxfev, enable_log_sampling=enable_log_sampling, log_sampling_dist=log_sampling_dist, weighting = weighting)
+    model, fit_indices, fit_results = self._categorize(Dapp, J, T, Dapp_err = Dapp_err, R=R, fraction_fit_points=fraction_fit_points, fit_max_time=fit_max_time, maxfev=maxfev, enable_log_sampling=enable_log_sampling, log_sampling_dist=log_sampling_dist, weighting = weighting)
 
     self._adc_analysis_results = {}
-    self._adc_analysis_results["Dapp"] = np.array(Dapp)
-    self._adc_analysis_results["Dapp_err"] = np.array(Dapp_err)
+    self._adc_analysis_results["Dapp"] = Dapp
+    self._adc_analysis_results["Dapp_err"] = Dapp_err
     self._adc_analysis_results["fit_indices"] = fit_indices
     self._adc_analysis_results["fit_results"] = fit_results
     self._adc_analysis_results["best_model"] = model
@@ -68,9 +79,19 @@ def adc_analysis(self, R: float = 1/6, fraction_fit_points: float=0.25, fit_max_
     return self._adc_analysis_results
 
     
-def plot_adc_analysis_results(self):
+def plot_adc_analysis_results(self, show: bool = True):
     """Plot the ADC analysis results.
 
+    Parameters
+    ----------
+    show: bool
+        If False, return the figure instead of calling plt.show().
+
+    Returns
+    -------
+    figure: matplotlib.figure.Figure
+        The figure if show is False, otherwise None.
+
     Raises
     ------
     ValueError
@@ -81,19 +102,19 @@ def plot_adc_analysis_results(self):
         raise ValueError(
             "Track has not been analyzed using adc_analysis yet!")
 
-    dt = self._t[1] - self._t[0]
-    N = self._t.size
-    T = np.linspace(1, N, N-3,  endpoint=True) * dt
-
     fit_results = self.get_adc_analysis_results()["fit_results"]
 
     Dapp = self.get_adc_analysis_results()["Dapp"]
     Dapp_err = self.get_adc_analysis_results()["Dapp_err"]
     idxs = self.get_adc_analysis_results()["fit_indices"]
 
+    # Same lag time grid as used in adc_analysis
+    dt = self._t[1] - self._t[0]
+    T = _time_grid(Dapp.size) * dt
+
     n_points = idxs[-1]
 
-    plt.figure(figsize=(8, 4))
+    fig = plt.figure(figsize=(8, 4))
     plt.grid(linestyle='dashed', color='grey')
     plt.semilogx(T, Dapp, label="Data", color='black')
     plt.fill_between(T, Dapp-Dapp_err, Dapp+Dapp_err, color='black', alpha=0.5)
@@ -122,4 +143,7 @@ def plot_adc_analysis_results(self):
     plt.xlim(T[0], T[-1])
     plt.legend(bbox_to_anchor=(1, 1), loc='upper left')
     plt.subplots_adjust(right=0.7)
-    plt.show()
\ No newline at end of file
+    if show:
+        plt.show()
+    else:
+        return fig
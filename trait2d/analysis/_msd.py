@@ -1,10 +1,15 @@
 from scipy import optimize
 import numpy as np
 import warnings
-import tqdm
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
 
 from trait2d.analysis.models import ModelLinear, ModelPower
 
+# Maximum number of elements of the intermediate arrays in `_msd_moments`
+_MSD_BLOCK_SIZE = 2**18
+
 def delete_msd_analysis_results(self):
     """Delete the MSD analysis results."""
     self._msd_analysis_results = None
@@ -27,7 +32,9 @@ def msd_analysis(self, fraction_fit_points: float = 0.25, n_fit_points: int = No
         Maximum time in fit range. Will override fraction_fit_points and n_fit_points.
     initial_guesses: dict
         Dictionary containing initial guesses for the parameters. Keys can be "model1" and "model2".
-        All values default to 1.
+        All values default to 1. Model1 is linear and is solved in closed form, so its initial
+        guesses are only used if that solution violates the parameter bounds and the fit falls
+        back to scipy.optimize.curve_fit.
     maxfev: int
         Maximum function evaluations by scipy.optimize.curve_fit. The fit will fail if this number is exceeded.
     R: float
@@ -40,9 +47,8 @@ def msd_analysis(self, fraction_fit_points: float = 0.25, n_fit_points: int = No
     p0 = {"model1" : 2 * [None], "model2" : 3*[None]}
     p0.update(initial_guesses)
 
-    # Calculate MSD if this has not been done yet.
-    if self._msd is None:
-        self.calculate_msd()
+    # Calculate MSD if this has not been done yet or the trajectory has changed.
+    self.calculate_msd()
 
     # Number time frames for this track
     N = self._msd.size
@@ -75,20 +81,26 @@ def msd_analysis(self, fraction_fit_points: float = 0.25, n_fit_points: int = No
     model2.R = R
     model1.dt = dt
     model2.dt = dt
+    model1.dim = self.get_dimension()
+    model2.dim = self.get_dimension()
 
     p0_model1 = [0.0, 0.0]
     for i in range(len(p0_model1)):
         if not p0["model1"][i] is None:
             p0_model1[i] = p0["model1"][i]
 
-    reg1 = optimize.curve_fit(
-        model1, T[0:n_points], self._msd[0:n_points], p0 = p0_model1, sigma=self._msd_error[0:n_points], maxfev=maxfev, method='trf', bounds=(0.0, np.inf))
+    # The linear model has a closed-form solution. Only fall back to the
+    # iterative fit if it violates the parameter bounds.
+    reg1 = _linear_fit(model1, T[0:n_points], self._msd[0:n_points], self._msd_error[0:n_points])
+    if reg1 is None:
+        reg1 = optimize.curve_fit(
+            model1, T[0:n_points], self._msd[0:n_points], p0 = p0_model1, sigma=self._msd_error[0:n_points], maxfev=maxfev, method='trf', bounds=(0.0, np.inf), jac=model1.jac)
 
     p0_model2 = [0.0, 0.0, 0.0]
     for i in range(len(p0_model2)):
         if not p0["model2"][i] is None:
             p0_model2[i] = p0["model2"][i]
-    reg2 = optimize.curve_fit(model2, T[0:n_points], self._msd[0:n_points], p0 = p0_model2, sigma=self._msd_error[0:n_points], maxfev=maxfev, method='trf', bounds=(0.0, np.inf))
+    reg2 = optimize.curve_fit(model2, T[0:n_points], self._msd[0:n_points], p0 = p0_model2, sigma=self._msd_error[0:n_points], maxfev=maxfev, method='trf', bounds=(0.0, np.inf), jac=model2.jac)
 
 
     # Compute standard deviation of parameters
@@ -96,10 +108,10 @@ def msd_analysis(self, fraction_fit_points: float = 0.25, n_fit_points: int = No
     perr_m2 = np.sqrt(np.diag(reg2[1]))
 
     # Compute BIC for both models
-    m1 = model1(T, *reg1[0])
-    m2 = model2(T, *reg2[0])
-    bic1 = BIC(m1[0:n_points], self._msd[0:n_points], 2, 1)
-    bic2 = BIC(m2[0:n_points], self._msd[0:n_points], 2, 1)
+    m1 = model1(T[0:n_points], *reg1[0])
+    m2 = model2(T[0:n_points], *reg2[0])
+    bic1 = BIC(m1, self._msd[0:n_points], 2, n_points)
+    bic2 = BIC(m2, self._msd[0:n_points], 3, n_points)
     # FIXME: numerical instabilities due to low position values. should normalize before analysis, and then report those adimentional values.
 
     # Relative Likelihood for each model
@@ -113,13 +125,20 @@ def msd_analysis(self, fraction_fit_points: float = 0.25, n_fit_points: int = No
 
     return self._msd_analysis_results
 
-def plot_msd_analysis_results(self, scale: str = 'log'):
+def plot_msd_analysis_results(self, scale: str = 'log', show: bool = True):
     """Plot the MSD analysis results.
 
     Parameters
     ----------
     scale: str
         How to scale the plot over time. Possible values: 'log', 'linear'.
+    show: bool
+        If False, return the figure instead of calling plt.show().
+
+    Returns
+    -------
+    figure: matplotlib.figure.Figure
+        The figure if show is False, otherwise None.
 
     Raises
     ------
@@ -134,6 +153,8 @@ def plot_msd_analysis_results(self, scale: str = 'log'):
     # Definining the models used for the fit
     model1 = ModelLinear()
     model2 = ModelPower()
+    model1.dim = self.get_dimension()
+    model2.dim = self.get_dimension()
 
     results = self.get_msd_analysis_results()["fit_results"]
     N = self._x.size
@@ -146,7 +167,7 @@ def plot_msd_analysis_results(self, scale: str = 'log'):
     rel_likelihood_1 = results["model1"]["rel_likelihood"]
     rel_likelihood_2 = results["model2"]["rel_likelihood"]
     # Plot the results
-    plt.figure()
+    fig = plt.figure()
     plt.grid(linestyle='dashed', color='grey')
     if scale == 'linear':
         plt.plot(T, self._msd, color='black', label="Data")
@@ -164,22 +185,184 @@ def plot_msd_analysis_results(self, scale: str = 'log'):
     plt.xlabel("Time")
     plt.ylabel("MSD")
     plt.legend()
-    plt.show()
+    if show:
+        plt.show()
+    else:
+        return fig
+
+def _linear_fit(model, t, y, sigma):
+    """Weighted linear least squares fit of a model that is linear in its parameters.
+
+    Gives the same result as `scipy.optimize.curve_fit` with `absolute_sigma=False`
+    but without iterating.
+
+    Parameters
+    ----------
+    model:
+        Model instance whose output is linear in its two parameters.
+    t: ndarray
+        Time points.
+    y: ndarray
+        Data to fit.
+    sigma: ndarray
+        Uncertainties of the data points.
+
+    Returns
+    -------
+    popt, pcov: tuple or None
+        Optimal parameters and their covariance or None if any optimal parameter
+        is negative.
+    """
+    A = np.column_stack((model(t, 1.0, 0.0), model(t, 0.0, 1.0))) / sigma[:, None]
+    b = y / sigma
+    popt, _, rank, _ = np.linalg.lstsq(A, b, rcond=None)
+    if rank < 2 or np.any(popt < 0.0):
+        return None
+
+    n = y.size
+    if n > 2:
+        chisq = np.sum(np.square(A @ popt - b))
+        pcov = np.linalg.inv(A.T @ A) * chisq / (n - 2)
+    else:
+        pcov = np.full((2, 2), np.inf)
+    return popt, pcov
+
+def _msd_fft(pos):
+    """Mean squared displacement for all lags using the FFT.
+
+    Uses the identity MSD(m) = <r(k+m)^2> + <r(k)^2> - 2 <r(k+m) r(k)>, where
+    the last term is the autocorrelation of the positions and can be obtained
+    in O(N log N) with a zero-padded real FFT. The first localisation is
+    skipped and lags run from 1 to N-3, matching `Track.calculate_msd`.
+
+    Parameters
+    ----------
+    pos: ndarray
+        Positions of shape (N, d).
+
+    Returns
+    -------
+    msd: ndarray
+        Mean squared displacement for lags 1 to N-3.
+    """
+    # Centering keeps the subtraction below well conditioned. The FFT is
+    # always computed in double precision.
+    p = pos[1:] - pos[1:].mean(axis=0, dtype=np.float64)
+    M = p.shape[0]
+    lags = np.arange(1, M - 1)
+    n = M - lags
 
-def MSD_loop(i, pos_x, pos_y, N):
-    idx_0 = np.arange(1, N-i-1, 1)
-    idx_t = idx_0 + i
-    this_msd = (pos_x[idx_t] - pos_x[idx_0])**2 + \
-        (pos_y[idx_t] - pos_y[idx_0])**2
+    # Sums of r(k+m)^2 and r(k)^2 over all valid k
+    cs = np.concatenate(([0.0], np.cumsum(np.einsum('kd,kd->k', p, p))))
+    s1 = (cs[M] - cs[lags]) + cs[M - lags]
 
-    MSD = np.mean(this_msd)
-    MSD_error = np.std(this_msd) / np.sqrt(len(this_msd))
+    # Autocorrelation, summed over all dimensions
+    f = np.fft.rfft(p, n=2 * M, axis=0)
+    acf = np.fft.irfft((f * f.conj()).real.sum(axis=1), n=2 * M)[lags]
+
+    return (s1 - 2.0 * acf) / n
+
+def _sd_moments_block(p, padded, msd, n_sd, first_lag, n_block):
+    """Mean and standard deviation of the squared displacements for one block of lags.
+
+    If `msd` is None, the mean is computed from the squared displacements of the
+    block as well, otherwise it is taken from `msd`.
+    """
+    M = p.shape[0]
+    n = n_sd[first_lag - 1:first_lag - 1 + n_block]
+
+    # windows[k, :, j] is the position at index k + first_lag + j
+    windows = sliding_window_view(padded[first_lag:], n_block, axis=0)[:M - first_lag]
+
+    # Displacements that reach into the padding, i.e. k >= M - (first_lag + j)
+    padding = np.arange(M - first_lag)[:, None] >= (M - first_lag - np.arange(n_block))
+
+    # Accumulate the squared displacements axis by axis in preallocated buffers.
+    # These are always double precision, even for single precision positions,
+    # since the deviations from the mean cancel badly otherwise, e.g. for
+    # drifting tracks.
+    sd = np.zeros((M - first_lag, n_block))
+    diff = np.empty_like(sd)
+    for axis in range(p.shape[1]):
+        np.subtract(windows[:, axis, :], p[:M - first_lag, axis, None], out=diff, dtype=np.float64)
+        np.square(diff, out=diff)
+        sd += diff
+    sd[padding] = 0.0
+
+    if msd is None:
+        mean = np.sum(sd, axis=0) / n
+    else:
+        mean = msd[first_lag - 1:first_lag - 1 + n_block]
+
+    sd -= mean
+    sd[padding] = 0.0
+
+    # Non-finite coordinates propagate to all lags whose displacements include them.
+    return mean, np.sqrt(np.einsum('kj,kj->j', sd, sd) / n)
+
+def _msd_moments(pos):
+    """Mean and standard deviation of the squared displacements for all lags.
+
+    The mean is obtained from `_msd_fft`. For the standard deviation, the
+    displacements of a whole block of lags are computed at once from a
+    strided view of the positions instead of looping over the lags in Python.
+    Blocks are limited to `_MSD_BLOCK_SIZE` elements so that long tracks do
+    not need the full N x N matrix. NumPy releases the GIL inside the block
+    computation, so multiple blocks are processed by a thread pool.
+
+    If the positions contain non-finite values, the FFT would spread them to
+    all lags. The mean is then computed directly in the blocks instead, so
+    that only the lags involving those positions become NaN.
+
+    Parameters
+    ----------
+    pos: ndarray
+        Positions of shape (N, d), e.g. in single precision. All computations
+        are carried out in float64.
+
+    Returns
+    -------
+    msd: ndarray
+        Mean squared displacement for lags 1 to N-3.
+    msd_error: ndarray
+        Standard deviation of the squared displacements for lags 1 to N-3.
+    """
+    p = pos[1:]
+    M, d = p.shape
+    n_lags = M - 2
+
+    msd = _msd_fft(pos) if np.isfinite(p).all() else None
+
+    # Number of squared displacements for each lag
+    n_sd = np.arange(M - 1, 1, -1)
+
+    # Pad so that the strided windows stay in bounds. Displacements into the
+    # padding are masked by their position, so the value is irrelevant.
+    padded = np.concatenate((p, np.zeros((n_lags, d), dtype=p.dtype)))
+    block = max(1, _MSD_BLOCK_SIZE // (M * d))
+
+    first_lags = range(1, n_lags + 1, block)
+    n_blocks = [min(block, n_lags + 1 - first_lag) for first_lag in first_lags]
+
+    if len(first_lags) > 1:
+        with ThreadPoolExecutor() as executor:
+            moments = list(executor.map(_sd_moments_block, itertools.repeat(p),
+                                        itertools.repeat(padded), itertools.repeat(msd),
+                                        itertools.repeat(n_sd),
+                                        first_lags, n_blocks))
+    else:
+        moments = [_sd_moments_block(p, padded, msd, n_sd, first_lag, n_block)
+                   for first_lag, n_block in zip(first_lags, n_blocks)]
 
-    return MSD, MSD_error
+    if not moments:
+        return np.empty(0), np.empty(0)
+    mean, msd_error = (np.concatenate(m) for m in zip(*moments))
+    return mean, msd_error
 
 
 def rayleighPDF(x, sigma):
-    return x / sigma**2 * np.exp(- x**2 / (2 * sigma**2))
+    sigma2 = sigma * sigma
+    return x / sigma2 * np.exp(- x * x / (2 * sigma2))
 
 
 def BIC(pred: list, target: list, k: int, n: int):
@@ -201,6 +384,6 @@ def BIC(pred: list, target: list, k: int, n: int):
         Bayesian Information Criterion
     """
     # Compute RSS
-    RSS = np.sum((np.array(pred) - np.array(target)) ** 2)
+    RSS = np.sum(np.square(np.asarray(pred) - np.asarray(target)))
     bic = k * np.log(n) + n * np.log(RSS / n)
     return bic
\ No newline at end of file
@@ -3,85 +3,233 @@
 
 import numpy as np
 
+def _fit_jac(model):
+    """Return the `jac` argument for scipy.optimize.curve_fit.
+
+    The model's `jac` is only used if it is defined on the same class as `__call__`.
+    A subclass that overrides `__call__` alone would otherwise inherit a Jacobian
+    that does not match its formula, so finite differences are used instead.
+    """
+    for cls in type(model).__mro__:
+        if "__call__" in vars(cls):
+            return model.jac if "jac" in vars(cls) else "2-point"
+    return "2-point"
+
+def _same_lag_times(cached, t):
+    """Check whether `t` holds the same values as the cached copy `cached`.
+
+    Comparing the values is much cheaper than the exp and log calls it saves.
+    """
+    return np.shape(t) == cached.shape and np.array_equal(t, cached)
+
 # Models used for ADC and SD analysis
 class ModelBase:
+    # The built-in models evaluate in place on a single freshly allocated result
+    # array. It is never reused between calls, since callers keep the predictions.
+    #
+    # Subclasses may define `jac(self, t, *params)` returning the partial
+    # derivatives as an array of shape (t.size, n_params). It is passed to
+    # scipy.optimize.curve_fit if it is defined in the same class as `__call__`,
+    # otherwise finite differences are used (see `_fit_jac`).
+    #
+    # These are class attributes so that subclasses overriding `__init__`
+    # without calling it still work.
+    # Number of spatial dimensions. Only used by the MSD models.
+    dim = 2
+    _relaxation_cache = None
+
     def __init__(self):
         self.R = 0.0
         self.dt = 0.0
 
+    def _relaxation(self, t, tau):
+        """Return 1 - exp(-t / tau), computed with expm1 to stay accurate for t << tau.
+
+        The last result is kept so that `__call__` and `jac` share it while the fitter
+        evaluates both at the same point. It is matched against a copy of the lag
+        times, so modifying `t` in place between calls is safe.
+        """
+        cache = self._relaxation_cache
+        if cache is None or cache[1] != tau or not _same_lag_times(cache[0], t):
+            cache = (np.array(t), tau, -np.expm1(-t / tau))
+            self._relaxation_cache = cache
+        return cache[2]
+
+    def _corrected_lag(self, t):
+        """Return t - 2 R dt, or t itself when there is no point scanning (R dt == 0).
+
+        The result may be `t`, so it must not be modified in place.
+        """
+        two_Rdt = 2.0 * self.R * self.dt
+        if two_Rdt == 0.0:
+            return t
+        return t - two_Rdt
+
+    # Terms shared by the ADC models. The `_jac` variants fill the columns of the
+    # Jacobian `J` belonging to the respective parameters.
+    def _confinement(self, t, D_micro, tau):
+        """Return D_micro * tau / t * (1 - exp(-t / tau)) as a new array."""
+        out = (D_micro * tau) * self._relaxation(t, tau)
+        out /= t
+        return out
+
+    def _confinement_jac(self, J, t, D_micro, tau, i_D_micro, i_tau):
+        g = self._relaxation(t, tau)
+        J[:, i_D_micro] = tau * g / t
+        J[:, i_tau] = D_micro * (g / t - (1.0 - g) / tau)
+
+    def _localisation(self, t, delta):
+        """Return delta^2 / (2 (t - 2 R dt)) as a new array."""
+        return (0.5 * delta * delta) / self._corrected_lag(t)
+
+    def _localisation_jac(self, J, t, delta, i_delta):
+        J[:, i_delta] = delta / self._corrected_lag(t)
+
 class ModelBrownian(ModelBase):
     r"""Model for free, unrestricted diffusion.
 
     .. math:: D_\mathrm{app} = D + \frac{\delta^2}{2 t (1 - 2 R (dt / t))}
     """
-    lower = [0.0, 0.0]
-    upper = np.inf
-    initial = [0.5e-12, 2.0e-9]
+    lower = np.array([0.0, 0.0])
+    upper = np.array([np.inf, np.inf])
+    initial = np.array([0.5e-12, 2.0e-9])
 
     def __call__(self, t, D, delta):
-        return D + delta**2 / (2*t*(1-2*self.R*self.dt/t))
+        out = self._localisation(t, delta)
+        out += D
+        return out
+
+    def jac(self, t, D, delta):
+        J = np.empty((np.size(t), 2))
+        J[:, 0] = 1.0
+        self._localisation_jac(J, t, delta, 1)
+        return J
 
 class ModelConfined(ModelBase):
     r"""Model for confined diffusion.
 
     .. math:: D_\mathrm{app} = D_\mu \cdot \frac{\tau}{t} \left( 1 - \exp \left( - \frac{\tau}{t} \right) \right) + \frac{\delta}{2 t (1 - 2 R (dt / t))}
     """
-    lower = [0.0, 0.0, 0.0]
-    upper = np.inf
-    initial = [0.5e-12, 2.0e-9, 1.0e-3]
+    lower = np.array([0.0, 0.0, 0.0])
+    upper = np.array([np.inf, np.inf, np.inf])
+    initial = np.array([0.5e-12, 2.0e-9, 1.0e-3])
 
     def __call__(self, t, D_micro, delta, tau):
-        return D_micro * (tau/t) * (1 - np.exp(-t/tau)) + \
-            delta ** 2 / (2 * t * (1 - 2 * self.R * self.dt / t))
+        out = self._confinement(t, D_micro, tau)
+        out += self._localisation(t, delta)
+        return out
+
+    def jac(self, t, D_micro, delta, tau):
+        J = np.empty((np.size(t), 3))
+        self._confinement_jac(J, t, D_micro, tau, 0, 2)
+        self._localisation_jac(J, t, delta, 1)
+        return J
 
 class ModelHop(ModelBase):
     r"""Model for hop diffusion.
 
     .. math:: D_\mathrm{app} = D_M + D_\mu \cdot \frac{\tau}{t} \left( 1 - \exp \left( - \frac{\tau}{t} \right) \right) + \frac{\delta}{2 t (1 - 2 R (dt / t))}
     """
-    lower = [0.0, 0.0, 0.0, 0.0]
-    upper = np.inf
-    initial = [0.5e-12, 0.5e-12, 2.0e-9, 1.0e-3]
+    lower = np.array([0.0, 0.0, 0.0, 0.0])
+    upper = np.array([np.inf, np.inf, np.inf, np.inf])
+    initial = np.array([0.5e-12, 0.5e-12, 2.0e-9, 1.0e-3])
 
     def __call__(self, t, D_macro, D_micro, delta, tau):
-        return D_macro + \
-            D_micro * (tau/t) * (1 - np.exp(-t/tau)) + \
-            delta ** 2 / (2 * t * (1 - 2 * self.R * self.dt / t))
+        out = self._confinement(t, D_micro, tau)
+        out += self._localisation(t, delta)
+        out += D_macro
+        return out
+
+    def jac(self, t, D_macro, D_micro, delta, tau):
+        J = np.empty((np.size(t), 4))
+        J[:, 0] = 1.0
+        self._confinement_jac(J, t, D_micro, tau, 1, 3)
+        self._localisation_jac(J, t, delta, 2)
+        return J
 
 class ModelImmobile(ModelBase):
     r"""Model for immobile diffusion.
 
     .. math:: D_\mathrm{app} =  \frac{\delta}{2 t (1 - 2 R (dt / t))}
     """
-    upper = [np.inf]
-    lower = [0.0]
-    initial = [0.5e-12]
+    upper = np.array([np.inf])
+    lower = np.array([0.0])
+    initial = np.array([0.5e-12])
 
     def __call__(self, t, delta):
-        return delta**2 / (2*t*(1-2*self.R*self.dt/t))
+        return self._localisation(t, delta)
+
+    def jac(self, t, delta):
+        J = np.empty((np.size(t), 1))
+        self._localisation_jac(J, t, delta, 0)
+        return J
 
 class ModelHopModified(ModelBase):
     r"""Modified model for hop diffusion.
 
     .. math::  D_\mathrm{app} = \alpha \cdot D_\mathrm{M} + (1 - \alpha) \cdot D_\mu \left(1 - \exp \left(- \frac{t}{\tau}\right)\right)
     """
-    lower = [0.0, 0.0, 0.0, 0.0]
-    upper = np.inf
-    initial = [0.5e-12, 0.5e-12, 0.0, 1.0e-3]
+    lower = np.array([0.0, 0.0, 0.0, 0.0])
+    upper = np.array([np.inf, np.inf, np.inf, np.inf])
+    initial = np.array([0.5e-12, 0.5e-12, 0.0, 1.0e-3])
     def __call__(self, t, D_macro, D_micro, alpha, tau):
-        return alpha * D_macro + \
-            (1.0 - alpha) * D_micro * (1 - np.exp(-t/tau))
+        out = ((1.0 - alpha) * D_micro) * self._relaxation(t, tau)
+        out += alpha * D_macro
+        return out
+
+    def jac(self, t, D_macro, D_micro, alpha, tau):
+        invtau = 1.0 / tau
+        g = self._relaxation(t, tau)
+        e = 1.0 - g
+        J = np.empty((np.size(t), 4))
+        J[:, 0] = alpha
+        J[:, 1] = (1.0 - alpha) * g
+        J[:, 2] = D_macro - D_micro * g
+        J[:, 3] = -(1.0 - alpha) * D_micro * e * t * invtau * invtau
+        return J
 
 
 # Models used for MSD analysis
 class ModelLinear(ModelBase):
     """Linear model for MSD analysis."""
     def __call__(self, t, D, delta2):
-        # 4 * D * t + 2 * delta2 - 8 * D * R * dt
-        return 4.0 * D * (t - 2.0 * self.R * self.dt) + 2.0 * delta2 
+        # 4 * D * t + 2 * delta2 - 8 * D * R * dt (in 2D)
+        out = t - 2.0 * self.R * self.dt
+        out *= 2.0 * self.dim * D
+        out += self.dim * delta2
+        return out
+
+    def jac(self, t, D, delta2):
+        J = np.empty((np.size(t), 2))
+        J[:, 0] = 2.0 * self.dim * (t - 2.0 * self.R * self.dt)
+        J[:, 1] = self.dim
+        return J
 
 class ModelPower(ModelBase):
     """Generic power law model for MSD analysis."""
+    _log_cache = None
+
+    def _log(self, t):
+        """Return log(t), kept for repeated calls on the same lag times (see `_relaxation`)."""
+        cache = self._log_cache
+        if cache is None or not _same_lag_times(cache[0], t):
+            cache = (np.array(t), np.log(t))
+            self._log_cache = cache
+        return cache[1]
+
     def __call__(self, t, D, delta2, alpha):
-        # 4 * D * t**alpha + 2 * delta2 - 8 * D * R * dt
-        return 4.0 * D * (t**alpha - 2.0 * self.R * self.dt) + 2.0 * delta2 
\ No newline at end of file
+        # 4 * D * t**alpha + 2 * delta2 - 8 * D * R * dt (in 2D)
+        out = np.exp(alpha * self._log(t))
+        out -= 2.0 * self.R * self.dt
+        out *= 2.0 * self.dim * D
+        out += self.dim * delta2
+        return out
+
+    def jac(self, t, D, delta2, alpha):
+        logt = self._log(t)
+        ta = np.exp(alpha * logt)
+        J = np.empty((np.size(t), 3))
+        J[:, 0] = 2.0 * self.dim * (ta - 2.0 * self.R * self.dt)
+        J[:, 1] = self.dim
+        J[:, 2] = 2.0 * self.dim * D * ta * logt
+        return J 
\ No newline at end of file